@@ -1,11 +1,17 @@
 import pandas as pd
-from PIL import Image, ImageDraw, ImageFont
-import textwrap
 from gtts import gTTS
 import os
 import asyncio
-from moviepy.editor import ImageClip, AudioFileClip, VideoFileClip, concatenate_videoclips
+import subprocess
+import time
+import shutil
+import functools
+import hashlib
+import uuid
+import concurrent.futures
+import multiprocessing
 from typing import List, Optional, Tuple # Added typing imports
+from slide_render import init_render_worker, render_in_worker, restore_cached_image, remove_if_exists
 
 # --- MCP Setup ---
 # Try importing the real FastMCP, fall back to a mock for demonstration
@@ -64,141 +70,175 @@ DEFAULT_LINE_SPACING = 10
 DEFAULT_MARGIN = 80
 DEFAULT_TEXT_WRAP_WIDTH = 45 # Adjusted for font size/resolution
 DEFAULT_FPS = 24
+TTS_MAX_WORKERS = 4 # Max concurrent gTTS requests; kept low to avoid rate limiting
+TTS_MAX_ATTEMPTS = 4 # gTTS tries per item before giving up
+TTS_RETRY_DELAY = 1.0 # Seconds before the first gTTS retry, doubled on each further retry
+NVENC_CODEC = "h264_nvenc" # NVIDIA hardware H.264 encoder
+CPU_CODEC = "libx264"
 DEFAULT_LANGUAGE = 'en' # Default language for gTTS
 DEFAULT_FONT_PATH = "HindVadodara-Light.ttf" # <<< IMPORTANT: Ensure this font exists or provide path
+TTS_CACHE_DIR = os.path.expanduser("~/.cache/mcq_tts") # Synthesized audio, keyed by (lang, text)
+IMAGE_CACHE_DIR = os.path.expanduser("~/.cache/mcq_images") # Rendered slides as PNG, keyed by (row, render settings)
 
 # --- Helper Functions ---
 
-def create_image_for_mcq(
-    data_row: List[str],
-    image_path: str,
-    width: int,
-    height: int,
-    bg_color: Tuple[int, int, int],
-    font_color: Tuple[int, int, int],
-    font_size: int,
-    font_path: str,
-    line_spacing: int,
-    margin: int,
-    wrap_width: int
-) -> str:
-    """Generates a single image for an MCQ item and returns the text content."""
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hardlinks src to dst, falling back to a copy (e.g., across filesystems)."""
+    remove_if_exists(dst)
     try:
-        image = Image.new("RGB", (width, height), bg_color)
-        draw = ImageDraw.Draw(image)
-        # Ensure font exists
-        if not os.path.exists(font_path):
-             raise FileNotFoundError(f"Font file not found at: {font_path}")
-        font = ImageFont.truetype(font_path, font_size)
-        y_position = margin
-        text_content = ""
-
-        for text in data_row:
-            if not isinstance(text, str): # Handle potential non-string data (e.g., NaN from pandas)
-                 text = str(text)
-            # Basic cleanup: remove excessive whitespace
-            text = ' '.join(text.split())
-            if not text: # Skip empty strings after cleanup
-                 continue
-
-            wrapped_text = textwrap.fill(text, width=wrap_width)
-            lines = wrapped_text.split('\n')
-
-            for line in lines:
-                # Calculate text width to potentially center or adjust later if needed
-                # text_width, text_height = draw.textsize(line, font=font) # Deprecated
-                try:
-                    # Use textbbox for more accurate size calculation
-                    bbox = draw.textbbox((margin, y_position), line, font=font)
-                    text_width = bbox[2] - bbox[0]
-                    text_height = bbox[3] - bbox[1] # Approx height, font_size is often sufficient
-                except AttributeError: # Fallback for older PIL/Pillow
-                     text_width = draw.textlength(line, font=font)
-
-
-                # Draw text - simple left alignment at margin
-                draw.text((margin, y_position), line, font=font, fill=font_color)
-                y_position += font_size + line_spacing # Move y down
-                text_content += line + " " # Add space for better TTS separation
-
-            y_position += line_spacing * 2 # Add extra spacing between original data elements
-
-        image.save(image_path)
-        return text_content.strip() # Return combined text for TTS
-
-    except FileNotFoundError as e:
-        raise e # Re-raise font not found error
-    except Exception as e:
-        raise RuntimeError(f"Error creating image {image_path}: {e}")
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def get_image_cache_key(data_row: List[str], render_settings: tuple) -> str:
+    """Returns the content hash identifying a rendered slide in IMAGE_CACHE_DIR."""
+    return hashlib.sha1(repr((tuple(data_row), render_settings)).encode("utf-8")).hexdigest()
+
+def get_speech_text(data_row: List[str]) -> str:
+    """Returns the narration text for an MCQ item: its non-empty cells, space separated."""
+    return " ".join(text for text in data_row if text)
 
 def create_audio_for_mcq(text: str, audio_path: str, lang: str) -> None:
-    """Generates a single MP3 audio file for the given text using gTTS."""
+    """Generates a single MP3 audio file for the given text using gTTS.
+
+    Results are cached in TTS_CACHE_DIR so identical text is only synthesized once.
+    """
     try:
-        tts = gTTS(text=text, lang=lang)
-        tts.save(audio_path)
+        key = hashlib.sha256(f"{lang}\0{text}".encode("utf-8")).hexdigest()
+        cached_path = os.path.join(TTS_CACHE_DIR, key + ".mp3")
+        if not os.path.exists(cached_path):
+            os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+            tts = gTTS(text=text, lang=lang)
+            # Write under a unique name so concurrent callers never see a partial file
+            tmp_path = f"{cached_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                # Google's endpoint rate-limits (429) or drops requests under load, so retry with backoff
+                for attempt in range(TTS_MAX_ATTEMPTS):
+                    try:
+                        tts.save(tmp_path)
+                        break
+                    except Exception as e:
+                        if attempt + 1 == TTS_MAX_ATTEMPTS:
+                            raise
+                        delay = TTS_RETRY_DELAY * 2 ** attempt
+                        print(f"  gTTS request for {audio_path} failed ({e}). Retrying in {delay:.0f}s...")
+                        time.sleep(delay)
+                os.replace(tmp_path, cached_path)
+            finally:
+                remove_if_exists(tmp_path)
+        _link_or_copy(cached_path, audio_path)
     except Exception as e:
         raise RuntimeError(f"Error creating audio {audio_path} with gTTS: {e}")
 
-def create_video_clip(image_path: str, audio_path: str, video_path: str, fps: int) -> float:
-    """Combines an image and audio into a video clip."""
+def get_audio_duration(audio_path: str) -> float:
+    """Returns the duration of an audio file in seconds, as reported by ffprobe."""
     try:
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image file not found: {image_path}")
-        if not os.path.exists(audio_path):
-            raise FileNotFoundError(f"Audio file not found: {audio_path}")
-
-        audio_clip = AudioFileClip(audio_path)
-        audio_duration = audio_clip.duration
-
-        if audio_duration is None or audio_duration <= 0:
-             print(f"Warning: Audio duration for {audio_path} is invalid ({audio_duration}). Using default 1s.")
-             audio_duration = 1.0 # Avoid zero duration clips
-
-        image_clip = ImageClip(image_path)
-        video_clip = image_clip.set_audio(audio_clip)
-        video_clip = video_clip.set_duration(audio_duration)
-        video_clip = video_clip.set_fps(fps)
-
-        # Write the video file
-        video_clip.write_videofile(video_path, codec="libx264", audio_codec="aac", logger=None) # Suppress verbose output
-
-        # Close clips to release resources
-        audio_clip.close()
-        image_clip.close()
-        video_clip.close()
-
-        return audio_duration # Return duration for potential use
-
+        output = subprocess.check_output(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=nw=1:nk=1", audio_path],
+            text=True
+        ).strip()
+        audio_duration = float(output) if output and output != "N/A" else None
     except Exception as e:
-        # Clean up potentially open clips on error
-        if 'audio_clip' in locals() and audio_clip: audio_clip.close()
-        if 'image_clip' in locals() and image_clip: image_clip.close()
-        if 'video_clip' in locals() and video_clip: video_clip.close()
-        raise RuntimeError(f"Error creating video clip {video_path}: {e}")
-
-def concatenate_videos(video_paths: List[str], final_video_path: str) -> None:
-    """Concatenates a list of video files into one."""
-    if not video_paths:
-        raise ValueError("No video paths provided for concatenation.")
-
-    clips = []
+        raise RuntimeError(f"Error reading audio duration of {audio_path}: {e}")
+
+    if audio_duration is None or audio_duration <= 0:
+         print(f"Warning: Audio duration for {audio_path} is invalid ({audio_duration}). Using default 1s.")
+         audio_duration = 1.0 # Avoid zero duration clips
+    return audio_duration
+
+def _concat_entry(path: str) -> str:
+    """Formats a path as a 'file' line for an ffmpeg concat demuxer list."""
+    escaped_path = path.replace("'", "'\\''") # Concat lists quote with '...' like a shell
+    return f"file '{escaped_path}'\n"
+
+def _run_ffmpeg(args: List[str]) -> None:
+    """Runs ffmpeg with the given arguments, raising RuntimeError on failure."""
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {result.stderr.strip()}")
+
+@functools.lru_cache(maxsize=None)
+def detect_video_codec() -> str:
+    """Returns the H.264 encoder to try first: NVENC if nvidia-smi exists and ffmpeg
+    lists h264_nvenc, else libx264.
+
+    This does not prove an NVENC session can be opened (no GPU passed through,
+    session limits, driver mismatch), so callers fall back to libx264 on failure.
+    """
+    if not shutil.which("nvidia-smi"):
+        return CPU_CODEC
     try:
-        for path in video_paths:
-            if not os.path.exists(path):
-                 raise FileNotFoundError(f"Video clip not found for concatenation: {path}")
-            clips.append(VideoFileClip(path))
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return CPU_CODEC
+    return NVENC_CODEC if NVENC_CODEC in result.stdout else CPU_CODEC
+
+def _video_encoder_args(video_codec: str) -> List[str]:
+    """Returns the ffmpeg output arguments for the chosen video encoder."""
+    if video_codec == NVENC_CODEC:
+        return ["-c:v", NVENC_CODEC, "-preset", "p4", "-tune", "ll", "-rc", "vbr", "-cq", "23"]
+    if video_codec == CPU_CODEC:
+        return ["-c:v", CPU_CODEC, "-preset", "ultrafast", "-tune", "stillimage", "-crf", "23",
+                "-threads", str(os.cpu_count() or 1)]
+    return ["-c:v", video_codec]
+
+def render_slideshow(
+    image_paths: List[str],
+    audio_paths: List[str],
+    durations: List[float],
+    final_video_path: str,
+    fps: int,
+    video_codec: str,
+    still_mode: bool = False
+) -> None:
+    """Encodes all slides and their narration into one video in a single ffmpeg pass.
+
+    With still_mode, each slide is encoded as a single keyframe held for its
+    duration (variable frame rate) instead of being repeated at a constant fps.
+    """
+    if not image_paths:
+        raise ValueError("No slides provided for rendering.")
 
-        final_clip = concatenate_videoclips(clips, method="compose") # Use 'compose' if clips have different sizes/fps potentially
-        final_clip.write_videofile(final_video_path, codec="libx264", audio_codec="aac", logger=None) # Suppress verbose output
+    work_dir = os.path.dirname(final_video_path)
+    image_list_path = os.path.join(work_dir, "concat.txt")
+    audio_list_path = os.path.join(work_dir, "audio_list.txt")
 
+    try:
+        # Image list: each slide is shown for the length of its narration.
+        # The last image is repeated since the demuxer ignores the final duration.
+        with open(image_list_path, "w", encoding="utf-8") as f:
+            for image_path, duration in zip(image_paths, durations):
+                f.write(_concat_entry(image_path))
+                f.write(f"duration {duration:.3f}\n")
+            f.write(_concat_entry(image_paths[-1]))
+
+        with open(audio_list_path, "w", encoding="utf-8") as f:
+            for audio_path in audio_paths:
+                f.write(_concat_entry(audio_path))
+
+        # One ffmpeg process reads both lists. gTTS output shares one MP3 format,
+        # so the narration segments join cleanly before being encoded to AAC.
+        _run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", image_list_path,
+            "-f", "concat", "-safe", "0", "-i", audio_list_path,
+            "-map", "0:v:0", "-map", "1:a:0",
+            # Still mode: one frame per slide, every frame a keyframe. -vsync (rather
+            # than -fps_mode, added in ffmpeg 5.1) keeps ffmpeg 4.x working.
+            *(["-vsync", "vfr", "-g", "1", "-keyint_min", "1"] if still_mode else ["-vf", f"fps={fps}"]),
+            "-pix_fmt", "yuv420p", # Needed for player compatibility
+            *_video_encoder_args(video_codec),
+            "-c:a", "aac", # AAC keeps the MP4 playable everywhere; narration encodes in well under a second
+            # In still mode the repeated last image lands exactly where the audio ends,
+            # and -shortest would drop the frame that carries the last slide's duration.
+            # The image list durations already match the narration, so it isn't needed.
+            *([] if still_mode else ["-shortest"]),
+            final_video_path
+        ])
     except Exception as e:
-        raise RuntimeError(f"Error concatenating videos to {final_video_path}: {e}")
-    finally:
-        # Ensure all clips are closed
-        for clip in clips:
-            clip.close()
-        if 'final_clip' in locals() and final_clip:
-            final_clip.close()
+        raise RuntimeError(f"Error rendering video {final_video_path}: {e}")
 
 
 # --- MCP Tool Definition ---
@@ -213,15 +253,17 @@ async def create_mcq_video(
     img_width: int = DEFAULT_IMAGE_WIDTH,
     img_height: int = DEFAULT_IMAGE_HEIGHT,
     bg_color_rgb: Tuple[int, int, int] = DEFAULT_BACKGROUND_COLOR,
-    font_color_rgb: Tuple[int, int, int] = DEFAULT_FONT_COLOR
+    font_color_rgb: Tuple[int, int, int] = DEFAULT_FONT_COLOR,
+    video_codec: Optional[str] = None,
+    still_mode: bool = False
 ) -> str:
     """
     Generates a video from Multiple Choice Questions stored in a CSV file.
 
     Each row in the CSV should represent one question slide. Columns typically
     contain the question, options (A, B, C, D), and the answer.
-    The tool creates an image and audio for each row, combines them into
-    a video clip, and finally concatenates all clips into a single video file.
+    The tool creates an image and audio for each row, then encodes all slides
+    with their narration into a single video file in one ffmpeg pass.
 
     Args:
         csv_file_path: Path to the input CSV file containing MCQ data.
@@ -235,10 +277,17 @@ async def create_mcq_video(
         img_height: Height of the output video/images in pixels. Defaults to 1080.
         bg_color_rgb: Background color as an RGB tuple (R, G, B). Defaults to (0, 127, 215).
         font_color_rgb: Font color as an RGB tuple (R, G, B). Defaults to (255, 255, 255).
+        video_codec: ffmpeg video encoder (e.g., 'h264_nvenc', 'libx264'). Defaults to
+                     auto-detection: NVENC when an NVIDIA GPU is available, else libx264.
+        still_mode: Encode each slide as one keyframe shown for its narration length
+                    (variable frame rate) instead of repeating it at 24 fps. Much faster
+                    to encode; some older players may not handle variable frame rate.
+                    Defaults to False.
 
     Returns:
         str: The absolute path to the generated final video file on success,
-             or an error message string on failure.
+             or an error message string on failure. If some items failed, the
+             path is followed by a line listing the missing item numbers.
     """
     print(f"Received request to create MCQ video from: {csv_file_path}")
     print(f"Output will be: {output_filename}")
@@ -258,13 +307,24 @@ async def create_mcq_video(
 
         final_video_full_path = os.path.join(output_dir, output_filename)
 
+        # An auto-detected NVENC encoder may still fail to open, so keep libx264 as a fallback
+        if video_codec is None:
+            video_codec = await asyncio.to_thread(detect_video_codec)
+            video_codecs = [video_codec] + ([CPU_CODEC] if video_codec != CPU_CODEC else [])
+        else:
+            video_codecs = [video_codec]
+        print(f"Using video encoder: {video_codec}")
+
         # --- 2. Load Data ---
         try:
             data_frame = pd.read_csv(csv_file_path, keep_default_na=False, dtype=str) # Read all as string, keep blanks
             # Handle potential empty rows or header issues if needed
             data_frame = data_frame.dropna(how='all') # Drop rows where *all* cells are NaN/empty
+            # Basic cleanup: collapse excessive whitespace, vectorized over each column
+            data_frame = data_frame.apply(lambda column: column.str.replace(r'\s+', ' ', regex=True).str.strip())
             if data_frame.empty:
                  return f"Error: CSV file '{csv_file_path}' seems to be empty or contains no valid data rows."
+            assert all(pd.api.types.is_string_dtype(column) for _, column in data_frame.items()), "CSV cells must load as strings" # Rendering relies on this
             data_list = data_frame.values.tolist()
             print(f"Loaded {len(data_list)} MCQ items from CSV.")
         except pd.errors.EmptyDataError:
@@ -273,84 +333,149 @@ async def create_mcq_video(
             return f"Error reading CSV file '{csv_file_path}': {e}"
 
         # --- 3. Process Each MCQ Item ---
-        individual_video_paths = []
-        total_duration = 0
-
-        for idx, data_row in enumerate(data_list):
+        # Items are processed concurrently. Slides render in a process pool so
+        # rasterization uses every core; gTTS requests run on their own thread
+        # pool since they mostly wait on the network.
+        loop = asyncio.get_running_loop()
+        tts_pool = concurrent.futures.ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix="gtts")
+
+        # Everything that affects a slide's pixels, for the image cache key. The font
+        # file's mtime and size catch a font replaced at the same path.
+        font_stat = os.stat(font_path)
+        render_settings = (
+            img_width, img_height, tuple(bg_color_rgb), tuple(font_color_rgb),
+            os.path.abspath(font_path), font_stat.st_mtime_ns, font_stat.st_size, font_size,
+            DEFAULT_LINE_SPACING, DEFAULT_MARGIN, DEFAULT_TEXT_WRAP_WIDTH
+        )
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        cached_image_files = [
+            os.path.join(IMAGE_CACHE_DIR, get_image_cache_key(data_row, render_settings) + ".png")
+            for data_row in data_list
+        ]
+        images_to_render = sum(not os.path.exists(path) for path in cached_image_files)
+
+        # Only start image workers if some slide actually needs rendering. They are
+        # spawned rather than forked, since the server and TTS pool run threads.
+        img_pool = None
+        if images_to_render:
+            img_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(os.cpu_count() or 1, images_to_render),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_render_worker,
+                initargs=(img_width, img_height, bg_color_rgb, font_path, font_size)
+            )
+
+        async def render_image(data_row: List[str], image_file: str, cached_image_file: str) -> None:
+            """Writes a slide's PPM, decoding it from the image cache when the row was rendered before."""
+            if img_pool is None or os.path.exists(cached_image_file):
+                print(f"  Reusing cached image for: {image_file}")
+                # PNG decoding releases the GIL, so a thread is enough here
+                await asyncio.to_thread(restore_cached_image, cached_image_file, image_file)
+            else:
+                await loop.run_in_executor(img_pool, functools.partial(
+                    render_in_worker,
+                    data_row, image_file, cached_image_file, bg_color_rgb, font_color_rgb,
+                    DEFAULT_LINE_SPACING, DEFAULT_MARGIN, DEFAULT_TEXT_WRAP_WIDTH
+                ))
+
+        async def process_item(idx: int, data_row: List[str]) -> Optional[Tuple[int, str, str, float]]:
             item_num = idx + 1
-            print(f"Processing item {item_num}/{len(data_list)}...")
 
             # Define paths for intermediate files for this item
-            image_file = os.path.join(output_dir, f"mcq_img_{item_num}.png")
+            image_file = os.path.join(output_dir, f"mcq_img_{item_num}.ppm")
             audio_file = os.path.join(output_dir, f"mcq_audio_{item_num}.mp3")
-            video_file = os.path.join(output_dir, f"mcq_video_{item_num}.mp4")
 
             try:
-                # a. Generate Image and get text
-                print(f"  Generating image: {image_file}")
-                # Run synchronous image creation in executor for better async behavior
-                text_for_speech = await asyncio.to_thread(
-                    create_image_for_mcq,
-                    data_row, image_file, img_width, img_height, bg_color_rgb,
-                    font_color_rgb, font_size, font_path, DEFAULT_LINE_SPACING,
-                    DEFAULT_MARGIN, DEFAULT_TEXT_WRAP_WIDTH
-                )
-
+                # The narration only depends on the row text, so it doesn't have to
+                # wait for the slide image
+                text_for_speech = get_speech_text(data_row)
                 if not text_for_speech:
-                    print(f"  Warning: No text content generated for item {item_num}. Skipping audio/video.")
-                    continue # Skip if no text content
+                    print(f"  Warning: No text content for item {item_num}. Skipping.")
+                    return None # Skip if no text content
 
-                # b. Generate Audio
+                print(f"Processing item {item_num}/{len(data_list)}...")
+                # a. Generate Image (CPU-bound, on the image worker processes)
+                print(f"  Generating image: {image_file}")
+                image_future = render_image(data_row, image_file, cached_image_files[idx])
+
+                # b. Generate Audio (synchronous gTTS call on the dedicated TTS pool)
                 print(f"  Generating audio: {audio_file} (lang={language})")
-                # Run synchronous gTTS call in executor
-                await asyncio.to_thread(create_audio_for_mcq, text_for_speech, audio_file, language)
-
-                # c. Generate Individual Video Clip
-                print(f"  Generating video clip: {video_file}")
-                # Run synchronous moviepy call in executor
-                clip_duration = await asyncio.to_thread(
-                    create_video_clip, image_file, audio_file, video_file, DEFAULT_FPS
-                )
-                individual_video_paths.append(video_file)
-                total_duration += clip_duration
-                print(f"  Item {item_num} processed. Clip duration: {clip_duration:.2f}s")
+                audio_future = loop.run_in_executor(tts_pool, create_audio_for_mcq, text_for_speech, audio_file, language)
+
+                # Wait for both so no write is still pending if cleanup runs below
+                for outcome in await asyncio.gather(image_future, audio_future, return_exceptions=True):
+                    if isinstance(outcome, BaseException):
+                        raise outcome
+
+                # c. Measure narration length, which sets how long the slide is shown
+                slide_duration = await asyncio.to_thread(get_audio_duration, audio_file)
+                print(f"  Item {item_num} processed. Slide duration: {slide_duration:.2f}s")
+                return idx, image_file, audio_file, slide_duration
 
             except Exception as e:
-                # Log error for the specific item but try to continue with others
+                # Log error for the specific item but let the other items continue
                 print(f"  Error processing item {item_num}: {e}. Skipping this item.")
                 # Optionally: Clean up partial files for this item
-                if os.path.exists(image_file): os.remove(image_file)
-                if os.path.exists(audio_file): os.remove(audio_file)
-                if os.path.exists(video_file): os.remove(video_file)
-                continue # Skip to next item
-
-        # --- 4. Concatenate Video Clips ---
-        if not individual_video_paths:
-            return "Error: No individual video clips were successfully generated. Final video cannot be created."
+                remove_if_exists(image_file)
+                remove_if_exists(audio_file)
+                raise
 
-        print(f"\nConcatenating {len(individual_video_paths)} video clips into {final_video_full_path}...")
-        print(f"Estimated total duration: {total_duration:.2f}s")
         try:
-             # Run synchronous moviepy call in executor
-             await asyncio.to_thread(concatenate_videos, individual_video_paths, final_video_full_path)
-             print("Concatenation complete.")
-        except Exception as e:
-            return f"Error during final video concatenation: {e}"
+            results = await asyncio.gather(
+                *(process_item(idx, data_row) for idx, data_row in enumerate(data_list)),
+                return_exceptions=True
+            )
+        finally:
+            # If the call is cancelled, drop queued work instead of letting it run unread
+            tts_pool.shutdown(wait=False, cancel_futures=True)
+            if img_pool: img_pool.shutdown(wait=False, cancel_futures=True)
+
+        failed_item_nums = [idx + 1 for idx, result in enumerate(results) if isinstance(result, BaseException)]
+
+        # Drop failed/skipped items and restore CSV order before rendering
+        processed_items = sorted(
+            (result for result in results if result is not None and not isinstance(result, BaseException)),
+            key=lambda result: result[0]
+        )
+        image_paths = [image_file for _, image_file, _, _ in processed_items]
+        audio_paths = [audio_file for _, _, audio_file, _ in processed_items]
+        slide_durations = [duration for _, _, _, duration in processed_items]
+
+        # --- 4. Render Final Video ---
+        if not processed_items:
+            return "Error: No MCQ items were successfully processed. Final video cannot be created."
+
+        print(f"\nRendering {len(processed_items)} slides into {final_video_full_path}...")
+        print(f"Estimated total duration: {sum(slide_durations):.2f}s")
+        for attempt, codec in enumerate(video_codecs):
+            try:
+                 # Run the blocking ffmpeg invocations in executor
+                 await asyncio.to_thread(
+                     render_slideshow, image_paths, audio_paths, slide_durations,
+                     final_video_full_path, DEFAULT_FPS, codec, still_mode
+                 )
+                 print("Rendering complete.")
+                 break
+            except Exception as e:
+                if attempt + 1 == len(video_codecs):
+                    return f"Error during final video rendering: {e}"
+                print(f"Warning: Encoding with {codec} failed ({e}). Retrying with {video_codecs[attempt + 1]}...")
 
         # --- 5. Cleanup (Optional) ---
         # Consider adding an option to keep or delete intermediate files
         # For now, we keep them in the output directory.
         # Example cleanup:
         # print("Cleaning up intermediate files...")
-        # for path in individual_video_paths:
-        #     img_path = path.replace(".mp4", ".png").replace("video", "img")
-        #     aud_path = path.replace(".mp4", ".mp3").replace("video", "audio")
+        # for path in image_paths + audio_paths:
         #     if os.path.exists(path): os.remove(path)
-        #     if os.path.exists(img_path): os.remove(img_path)
-        #     if os.path.exists(aud_path): os.remove(aud_path)
 
         # --- 6. Return Result ---
         print(f"Successfully generated final video: {final_video_full_path}")
+        if failed_item_nums:
+            # Don't let a partial video pass as complete
+            failed_list = ", ".join(str(item_num) for item_num in failed_item_nums)
+            return (f"{final_video_full_path}\n"
+                    f"Warning: items {failed_list} failed and are missing from the video.")
         return final_video_full_path
 
     except Exception as e:
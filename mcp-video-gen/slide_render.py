@@ -0,0 +1,124 @@
+"""Slide rendering for the MCQ video generator.
+
+Lives outside main.py so image worker processes can import it by name: the
+mcp CLI loads main.py under a module name that child processes can't import.
+"""
+import os
+import textwrap
+import uuid
+import contextlib
+import functools
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+@dataclass
+class RenderContext:
+    """A reusable canvas and loaded font for rendering MCQ slides."""
+    image: Image.Image
+    draw: ImageDraw.ImageDraw
+    font: ImageFont.FreeTypeFont
+
+def create_render_context(
+    width: int,
+    height: int,
+    bg_color: Tuple[int, int, int],
+    font_path: str,
+    font_size: int
+) -> RenderContext:
+    """Allocates a canvas and parses the font once so they can be reused across slides."""
+    image = Image.new("RGB", (width, height), bg_color)
+    return RenderContext(image=image, draw=ImageDraw.Draw(image), font=ImageFont.truetype(font_path, font_size))
+
+@functools.lru_cache(maxsize=None)
+def get_text_wrapper(wrap_width: int) -> textwrap.TextWrapper:
+    """Returns a shared TextWrapper, so one isn't constructed for every cell."""
+    return textwrap.TextWrapper(width=wrap_width)
+
+def create_image_for_mcq(
+    data_row: List[str],
+    image_path: str,
+    ctx: RenderContext,
+    bg_color: Tuple[int, int, int],
+    font_color: Tuple[int, int, int],
+    line_spacing: int,
+    margin: int,
+    wrap_width: int
+) -> None:
+    """Generates a single image for an MCQ item and saves it to image_path.
+
+    The context's canvas is cleared and redrawn, so a context must not be shared
+    between concurrent calls (each image worker process owns one).
+    """
+    try:
+        width, height = ctx.image.size
+        draw = ctx.draw
+        font = ctx.font
+        draw.rectangle([0, 0, width, height], fill=bg_color) # Clear the previous slide
+        line_height = font.size # Line pitch is the font size, as before
+        wrapper = get_text_wrapper(wrap_width)
+        y_position = margin
+
+        for text in data_row:
+            if not text: # Skip empty cells (whitespace is already collapsed at CSV load)
+                 continue
+
+            lines = wrapper.wrap(text)
+
+            for line in lines:
+                # Draw text - simple left alignment at margin
+                draw.text((margin, y_position), line, font=font, fill=font_color)
+                y_position += line_height + line_spacing # Move y down
+
+            y_position += line_spacing * 2 # Add extra spacing between original data elements
+
+        # Intermediate slides are read once by ffmpeg; PPM is the raw RGB buffer plus
+        # a short header, so neither side pays for compression
+        ctx.image.save(image_path, "PPM")
+
+    except FileNotFoundError as e:
+        raise e # Re-raise font not found error
+    except Exception as e:
+        raise RuntimeError(f"Error creating image {image_path}: {e}")
+
+def remove_if_exists(path: str) -> None:
+    """Deletes path, ignoring it if it was never created."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+# Each image worker process renders into its own RenderContext
+_worker_render_context: Optional[RenderContext] = None
+
+def init_render_worker(
+    width: int,
+    height: int,
+    bg_color: Tuple[int, int, int],
+    font_path: str,
+    font_size: int
+) -> None:
+    """ProcessPoolExecutor initializer: creates the worker's RenderContext once."""
+    global _worker_render_context
+    _worker_render_context = create_render_context(width, height, bg_color, font_path, font_size)
+
+def render_in_worker(data_row: List[str], image_path: str, cached_image_path: str, *args) -> None:
+    """Renders a slide to image_path in an image worker process with its RenderContext.
+
+    The slide is also stored in the image cache as a fast-compressed PNG, so
+    cache entries stay small while the output directory gets the raw PPM.
+    """
+    remove_if_exists(image_path) # Never write through a hardlink from an older run
+    create_image_for_mcq(data_row, image_path, _worker_render_context, *args)
+    # Write under a unique name so concurrent rows never see a partial file
+    tmp_path = f"{cached_image_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        _worker_render_context.image.save(tmp_path, "PNG", compress_level=1)
+        os.replace(tmp_path, cached_image_path)
+    finally:
+        remove_if_exists(tmp_path)
+
+def restore_cached_image(cached_image_path: str, image_path: str) -> None:
+    """Decodes a cached PNG slide into the PPM that ffmpeg reads."""
+    remove_if_exists(image_path)
+    with Image.open(cached_image_path) as image:
+        image.save(image_path, "PPM")